@@ -1,10 +1,14 @@
+import copy
+
 import hydra
 import pytorch_lightning as pl
 import torch
 import torch.nn.functional as F
 from omegaconf import DictConfig
+from pytorch_lightning.utilities import rank_zero_only
 
 from src.utils import get_logger
+from src.utils.models import fuse_conv_bn
 
 log = get_logger(__name__)
 
@@ -43,13 +47,24 @@ class LitModel(pl.LightningModule):
 
         self.example_input_array = self.model.get_example_input_array()
 
+        # NHWC conv weights unlock the Tensor Core cuDNN kernels; only 4D parameters are affected
+        self.model = self.model.to(memory_format=torch.channels_last)
+
+        # Fuse kernels on GPU for the training and validation steps. Only the forward function is compiled, so
+        # self.model stays a plain module: checkpoint keys and exports are the same with or without CUDA.
+        self.compiled_forward = (
+            torch.compile(self.model.forward, mode="reduce-overhead", fullgraph=False)
+            if torch.cuda.is_available()
+            else self.model.forward
+        )
+
     def forward(self, x: torch.Tensor) -> torch.Tensor:
         return self.model(x)
 
     def training_step(self, batch, _) -> torch.Tensor:
         states, policies, values = batch
 
-        preds = self.model(states)
+        preds = self.compiled_forward(states)
         policies_pred = preds[:, :-1]
         values_pred = preds[:, -1].unsqueeze(1)
 
@@ -68,7 +83,7 @@ class LitModel(pl.LightningModule):
     def validation_step(self, batch, _) -> torch.Tensor:
         states, policies, values = batch
 
-        preds = self.model(states)
+        preds = self.compiled_forward(states)
         policies_pred = preds[:, :-1]
         values_pred = preds[:, -1].unsqueeze(1)
 
@@ -78,29 +93,51 @@ class LitModel(pl.LightningModule):
         value_loss = F.mse_loss(values, values_pred)
         loss = policy_loss + value_loss
 
-        self.log("val_policy_loss", policy_loss, prog_bar=True, logger=True)
-        self.log("val_value_loss", value_loss, prog_bar=True, logger=True)
-        self.log("val_loss", loss, prog_bar=True, logger=True)
+        self.log("val_policy_loss", policy_loss, prog_bar=True, logger=True, sync_dist=True)
+        self.log("val_value_loss", value_loss, prog_bar=True, logger=True, sync_dist=True)
+        self.log("val_loss", loss, prog_bar=True, logger=True, sync_dist=True)
 
+    @rank_zero_only
     def on_save_checkpoint(self, checkpoint) -> None:
         self.save_torchscript("new.pt")
 
     def save_torchscript(self, path: str):
-        self.eval()
+        # Trace a folded copy so that the training weights and BatchNorm statistics are left intact
+        model = copy.deepcopy(self.model).to("cpu").eval()
+        model = fuse_conv_bn(model)
+        # INT8 weights for the Linear layers, which dominate the CPU inference cost of the engine
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
 
-        traced_script_module = torch.jit.trace(self.model.to("cpu"), self.example_input_array.to("cpu"))
+        traced_script_module = torch.jit.trace(model, self.example_input_array.to("cpu"))
         traced_script_module.save(path)
 
-        self.train()
-        self.model.to(self.device)
+    def save_onnx(self, path: str):
+        # Dynamic batch axis so that ONNX Runtime can evaluate several positions per call
+        self.to_onnx(
+            path,
+            self.example_input_array,
+            export_params=True,
+            opset_version=17,
+            input_names=["x"],
+            output_names=["pv"],
+            dynamic_axes={"x": {0: "B"}, "pv": {0: "B"}},
+        )
 
+    @rank_zero_only
     def on_train_end(self):
-        self.to_onnx("test.onnx")
+        self.save_onnx("model.onnx")
 
         self.save_torchscript("new.pt")
 
     def configure_optimizers(self):
         if self.scheduler is None:
-            return self.optimizer
+            return {"optimizer": self.optimizer}
+
+        return {
+            "optimizer": self.optimizer,
+            "lr_scheduler": {"scheduler": self.scheduler, "interval": "epoch", "frequency": 1},
+        }
 
-        return [self.optimizer], [{"scheduler": self.scheduler, "interval": "epoch"}]
+    def optimizer_zero_grad(self, epoch, batch_idx, optimizer, optimizer_idx=0):
+        # Drop the gradients instead of writing zeros into them
+        optimizer.zero_grad(set_to_none=True)
@@ -2,6 +2,7 @@ import random
 
 import hydra
 import pytorch_lightning as pl
+import torch
 from omegaconf import DictConfig
 
 from src.utils import get_logger
@@ -15,6 +16,9 @@ def train(config: DictConfig) -> None:
     seed = config.get("seed", random.randint(0, 1_000_000))
     pl.seed_everything(seed, workers=True)
 
+    # Allow TF32 for the matmuls that autocast leaves in FP32
+    torch.set_float32_matmul_precision("high")
+
     # Model
     log.info("Creating LitModel.")
     model: pl.LightningModule = hydra.utils.instantiate(config.lit_model, _recursive_=False)
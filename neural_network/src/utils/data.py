@@ -1,62 +1,76 @@
 import os
+from typing import Callable, Optional
+import numpy as np
+import orjson
 import torch
-import json
 import hydra
 import pytorch_lightning as pl
 from omegaconf import DictConfig
-from torch.utils.data import DataLoader, TensorDataset, random_split
+from torch.utils.data import DataLoader, TensorDataset
 from tqdm.auto import tqdm
 
 DATA_DIR = "games"
+DATA_PATH = "data_conv.pt"
 
 def augment(states, policies, values):
     N = states.size(0)
 
-    states_rotations = [states]
-    policies_rotations = [policies]
+    # Write each rotation straight into its slice of the final tensors
+    augmented_states = torch.empty((4 * N, states.size(1)), dtype=states.dtype)
+    augmented_policies = torch.empty((4 * N, policies.size(1)), dtype=policies.dtype)
 
     turns = states[:, -1].unsqueeze(1)
     states = states[:, :-1].reshape(N, 8, 8)
     policies = policies.reshape(N, 8, 8)
 
-    for k in (1, 2, 3):
-        states_rot = torch.rot90(states, k, dims=[1, 2]).reshape(N, -1)
-        states_rot = torch.cat((states_rot, turns), dim=-1)
-        states_rotations.append(states_rot)
-    states = torch.cat(states_rotations)
+    for k in range(4):
+        rows = slice(k * N, (k + 1) * N)
+        augmented_states[rows, :-1] = torch.rot90(states, k, dims=[1, 2]).reshape(N, -1)
+        augmented_states[rows, -1:] = turns
+        augmented_policies[rows] = torch.rot90(policies, k, dims=[1, 2]).reshape(N, -1)
 
-    for k in (1, 2, 3):
-        policies_rot = torch.rot90(policies, k, dims=[1, 2]).reshape(N, -1)
-        policies_rotations.append(policies_rot)
-    policies = torch.cat(policies_rotations).reshape(N*4, -1)
+    values = values.repeat(4, 1)
 
-    values = torch.cat([values] * 4)
+    return augmented_states, augmented_policies, values
 
-    return states, policies, values
+def load_game_data(filename):
+    with open(filename, "rb") as f:
+        return orjson.loads(f.read())
 
 def parse_game_data_from_json():
-    policies = []
-    values = []
-    states = []
-
     filenames = [os.path.join(DATA_DIR, f) for f in os.listdir(DATA_DIR)]
-    for filename in tqdm(filenames):
-        with open(filename) as f:
-            data = json.load(f)
 
-        for game_data in data:
-            states.append(game_data["state"])
-            policies.append(game_data["policy"])
-            values.append(game_data["value"])
+    # First pass: count the samples so that the buffers are only allocated once
+    counts = [len(load_game_data(filename)) for filename in tqdm(filenames)]
+    N = sum(counts)
+
+    # States only hold 0.0 and 1.0 (Board::to_flat_array writes Player::to_f32 for the pieces and the turn),
+    # so they fit in int8; policies are probabilities, so half precision is enough
+    sample = load_game_data(filenames[0])[0]
+    states = np.empty((N, len(sample["state"])), dtype=np.int8)
+    policies = np.empty((N, len(sample["policy"])), dtype=np.float16)
+    values = np.empty((N, 1), dtype=np.float16)
+
+    # Second pass: write each game directly into its slice of the buffers
+    offset = 0
+    for filename, count in zip(tqdm(filenames), counts):
+        data = load_game_data(filename)
+
+        rows = slice(offset, offset + count)
+        states[rows] = [game_data["state"] for game_data in data]
+        policies[rows] = [game_data["policy"] for game_data in data]
+        values[rows, 0] = [game_data["value"] for game_data in data]
 
-    states = torch.FloatTensor(states)
-    policies = torch.FloatTensor(policies)
-    values = torch.FloatTensor(values).unsqueeze(1)
+        offset += count
+
+    states = torch.from_numpy(states)
+    policies = torch.from_numpy(policies)
+    values = torch.from_numpy(values)
 
     # Data augmentation
     states, policies, values = augment(states, policies, values)
 
-    torch.save((states, policies, values), "data_conv.pt")
+    torch.save((states, policies, values), DATA_PATH)
 
     print(states.shape)
     print(policies.shape)
@@ -65,34 +79,154 @@ def parse_game_data_from_json():
     return states, policies, values
 
 
+class DeviceDataLoader:
+    """Batches a TensorDataset whose tensors already live on the training device.
+
+    Under DDP every rank draws the same permutation and keeps an equally sized, disjoint share of it,
+    like DistributedSampler does. The permutation is seeded with the epoch returned by get_epoch, so
+    resuming from a checkpoint continues the sequence instead of replaying it. Without shuffling each
+    rank gets a contiguous shard instead, and the shards together cover every sample.
+    """
+
+    def __init__(
+        self,
+        dataset: TensorDataset,
+        batch_size: int,
+        shuffle: bool = False,
+        drop_last: bool = False,
+        rank: int = 0,
+        world_size: int = 1,
+        get_epoch: Optional[Callable[[], int]] = None,
+    ):
+        self.tensors = dataset.tensors
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.rank = rank
+        self.world_size = world_size
+        self.get_epoch = get_epoch
+
+        if shuffle:
+            self.num_samples = len(dataset) // world_size
+            self.offset = 0
+        else:
+            shard_size = (len(dataset) + world_size - 1) // world_size
+            self.offset = min(rank * shard_size, len(dataset))
+            self.num_samples = min(shard_size, len(dataset) - self.offset)
+
+        self.seed = torch.initial_seed()
+
+    def __len__(self):
+        if self.drop_last:
+            return self.num_samples // self.batch_size
+        return (self.num_samples + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        device = self.tensors[0].device
+        if self.shuffle:
+            epoch = self.get_epoch() if self.get_epoch is not None else 0
+            generator = torch.Generator(device=device).manual_seed(self.seed + epoch)
+            indices = torch.randperm(len(self.tensors[0]), generator=generator, device=device)
+            indices = indices[self.rank :: self.world_size][: self.num_samples]
+
+        for start in range(0, len(self) * self.batch_size, self.batch_size):
+            if self.shuffle:
+                batch_indices = indices[start : start + self.batch_size]
+            else:
+                # Contiguous shards are sliced instead of gathered
+                end = min(start + self.batch_size, self.num_samples)
+                batch_indices = slice(self.offset + start, self.offset + end)
+            yield tuple(tensor[batch_indices] for tensor in self.tensors)
+
+
 class DataModule(pl.LightningDataModule):
-    def __init__(self, batch_size: int, shuffle: bool = True, num_workers: int = 1):
+    def __init__(
+        self,
+        batch_size: int,
+        shuffle: bool = True,
+        num_workers: Optional[int] = 1,
+        pin_memory: bool = True,
+        prefetch_factor: int = 4,
+        on_device: bool = False,
+    ):
         super().__init__()
 
         self.batch_size = batch_size
         self.shuffle = shuffle
+        # When num_workers is None, split the CPUs evenly between the DDP processes
+        if num_workers is None:
+            num_workers = os.cpu_count() // max(1, torch.cuda.device_count())
         self.num_workers = num_workers
+        self.pin_memory = pin_memory
+        self.prefetch_factor = prefetch_factor
+        self.on_device = on_device
+
+    def prepare_data(self):
+        # Runs on a single process, so the games are parsed and cached once rather than by every DDP rank
+        parse_game_data_from_json()
 
     def setup(self, stage=None):
-        # if os.path.exists("data.pt"):
-        #     states, policies, values = torch.load("data.pt")
-        # else:
-        states, policies, values = parse_game_data_from_json()
+        states, policies, values = torch.load(DATA_PATH)
+
+        # Upload the whole dataset once instead of copying every batch from the host
+        if self.on_device:
+            device = self.trainer.strategy.root_device
+            states, policies, values = states.to(device), policies.to(device), values.to(device)
+
+        # States stay int8 and are cast by the model itself
+        policies, values = policies.float(), values.float()
 
-        dataset = TensorDataset(states, policies, values)
+        # Fixed split (identical on every DDP rank), sliced once into contiguous tensors
+        N = states.size(0)
+        val_len = min(1024, int(N * 0.9))
+        generator = torch.Generator().manual_seed(0)
+        permutation = torch.randperm(N, generator=generator).to(states.device)
+        self.val_idx, self.train_idx = permutation[:val_len], permutation[val_len:]
 
-        val_len = min(1024, int(len(dataset) * 0.9))
-        train_len = len(dataset) - val_len
-        self.train_set, self.val_set = random_split(dataset, [train_len, val_len])
+        self.train_set = TensorDataset(states[self.train_idx], policies[self.train_idx], values[self.train_idx])
+        self.val_set = TensorDataset(states[self.val_idx], policies[self.val_idx], values[self.val_idx])
 
     def train_dataloader(self):
+        if self.on_device:
+            return DeviceDataLoader(
+                self.train_set,
+                batch_size=self.batch_size,
+                shuffle=self.shuffle,
+                drop_last=True,
+                rank=self.trainer.global_rank,
+                world_size=self.trainer.world_size,
+                get_epoch=lambda: self.trainer.current_epoch,
+            )
+
         return DataLoader(
-            self.train_set, batch_size=self.batch_size, shuffle=self.shuffle, num_workers=self.num_workers
+            self.train_set,
+            batch_size=self.batch_size,
+            shuffle=self.shuffle,
+            drop_last=True,
+            **self.get_loader_kwargs(),
         )
 
     def val_dataloader(self):
+        if self.on_device:
+            return DeviceDataLoader(
+                self.val_set,
+                batch_size=self.batch_size,
+                shuffle=False,
+                rank=self.trainer.global_rank,
+                world_size=self.trainer.world_size,
+            )
+
         return DataLoader(
-            self.val_set, batch_size=self.batch_size, shuffle=False, num_workers=self.num_workers
+            self.val_set, batch_size=self.batch_size, shuffle=False, **self.get_loader_kwargs()
+        )
+
+    def get_loader_kwargs(self):
+        # Keep the workers alive across epochs; prefetching only applies to worker processes
+        return dict(
+            num_workers=self.num_workers,
+            pin_memory=self.pin_memory,
+            persistent_workers=self.num_workers > 0,
+            prefetch_factor=self.prefetch_factor if self.num_workers > 0 else None,
         )
 
 if __name__ == "__main__":
@@ -1,18 +1,7 @@
 import torch
-from einops import repeat, rearrange
 from torch import nn
-
-
-class DepthwiseSeparableConv(nn.Module):
-    def __init__(self, in_channels, out_channels, kernel_size, padding=0, bias=False):
-        super().__init__()
-        self.depthwise = nn.Conv2d(in_channels, in_channels, kernel_size, padding=padding, bias=bias, groups=in_channels)
-        self.pointwise= nn.Conv2d(in_channels, out_channels, kernel_size=1, padding=padding, bias=bias)
-
-    def forward(self, x):
-        out = self.depthwise(x)
-        out = self.pointwise(out)
-        return out
+from torch.nn.modules.batchnorm import _BatchNorm
+from torch.nn.utils.fusion import fuse_conv_bn_eval
 
 
 class FlatModel(nn.Module):
@@ -36,10 +25,12 @@ class FlatModel(nn.Module):
         )
 
     def forward(self, x: torch.Tensor) -> tuple[torch.Tensor, torch.Tensor]:
+        x = x.float()
         x = self.backbone(x)
         x = self.policy_value(x)
-        x[:, -1] = torch.tanh(x[:, -1])
-        return x
+        policy = x[:, :-1]
+        value = torch.tanh(x[:, -1:])
+        return torch.cat((policy, value), dim=1)
 
     def get_example_input_array(self) -> torch.Tensor:
         return torch.zeros(1, self.size**2 + 1)
@@ -61,6 +52,22 @@ class ResidualBlock(nn.Module):
         return x
 
 
+def fuse_conv_bn(model: nn.Module) -> nn.Module:
+    """Folds every BatchNorm, SyncBatchNorm included, into the preceding Conv2d. The model must be in eval mode."""
+    for module in list(model.modules()):
+        children = list(module.named_children())
+        for (conv_name, conv), (bn_name, bn) in zip(children, children[1:]):
+            if isinstance(conv, nn.Conv2d) and isinstance(bn, _BatchNorm):
+                setattr(module, conv_name, fuse_conv_bn_eval(conv, bn))
+                setattr(module, bn_name, nn.Identity())
+
+    return model
+
+
+# Leaf layers that get_flat_shape can skip because they keep the number of channels and the spatial size
+SHAPE_PRESERVING_LAYERS = (nn.BatchNorm2d, nn.SiLU, nn.ReLU, nn.Tanh, nn.Identity, nn.Dropout)
+
+
 class ConvModel(nn.Module):
 
     def __init__(self, size: int) -> None:
@@ -79,62 +86,61 @@ class ConvModel(nn.Module):
         #     *[ResidualBlock(128) for _ in range(3)
         # ])
 
+        # Dense convs: on boards this small, depthwise + pointwise pairs cost more in launches than they save
         self.backbone = nn.Sequential(
-            DepthwiseSeparableConv(in_channels=2, out_channels=64, kernel_size=3),
+            nn.Conv2d(in_channels=2, out_channels=64, kernel_size=3),
             nn.SiLU(inplace=True),
-            DepthwiseSeparableConv(in_channels=64, out_channels=128, kernel_size=3),
+            nn.Conv2d(in_channels=64, out_channels=128, kernel_size=3),
             nn.SiLU(inplace=True),
-            DepthwiseSeparableConv(in_channels=128, out_channels=256, kernel_size=3),
+            nn.Conv2d(in_channels=128, out_channels=256, kernel_size=3),
             nn.SiLU(inplace=True),
         )
 
-        # self.backbone = nn.Sequentia(
-        #     nn.Conv2d(in_channels=2, out_channels=64, kernel_size=3),
-        #     nn.SiLU(inplace=True),
-        #     nn.Conv2d(in_channels=64, out_channels=128, kernel_size=3),
-        #     nn.SiLU(inplace=True),
-        #     nn.Conv2d(in_channels=128, out_channels=256, kernel_size=3),
-        #     nn.SiLU(inplace=True),
-        # )
-
         self.flat_shape = self.get_flat_shape()
-        print("self.flat_shape", self.flat_shape)
 
-        self.policy = nn.Sequential(
+        self.policy_value = nn.Sequential(
             nn.Linear(self.flat_shape, 256),
             nn.SiLU(inplace=True),
-            nn.Linear(256, self.size**2)
-        )
-
-        self.value = nn.Sequential(
-            nn.Linear(self.flat_shape, 128),
-            nn.SiLU(inplace=True),
-            nn.Linear(128, 1),
-            nn.Tanh()
+            nn.Linear(256, self.size**2 + 1)
         )
 
     def forward(self, x: torch.Tensor) -> tuple[torch.Tensor, torch.Tensor]:
-        turns = x[:, -1]
-        turns = repeat(turns, "b -> b 1 w h", w=self.size, h=self.size)
+        x = x.float()
+        batch_size = x.size(0)
 
-        x = x[:, :-1]
+        turns = x[:, -1].view(batch_size, 1, 1, 1).expand(batch_size, 1, self.size, self.size)
 
-        x = rearrange(x, "b (w h) -> b 1 w h", w=self.size, h=self.size)
-        x = torch.cat((x, turns), dim=1)
+        x = x[:, :-1].reshape(batch_size, 1, self.size, self.size)
+        x = torch.cat((x, turns), dim=1).contiguous(memory_format=torch.channels_last)
 
         x = self.backbone(x)
 
         x = x.reshape(-1, self.flat_shape)
 
-        policy = self.policy(x)
-        value = self.value(x)
-
+        x = self.policy_value(x)
+        policy = x[:, :-1]
+        value = torch.tanh(x[:, -1:])
         return torch.cat((policy, value), dim=1)
 
     def get_flat_shape(self) -> int:
-        x = torch.zeros(1, 2, self.size, self.size)
-        out = self.backbone(x)
-        return out.flatten().size(0)
+        """Computes the backbone's output size without a forward pass.
+
+        Only Conv2d layers may change the shape; any other layer must be one of SHAPE_PRESERVING_LAYERS.
+        """
+        size = self.size
+        channels = 2
+        for module in self.backbone.modules():
+            if isinstance(module, nn.Conv2d):
+                channels = module.out_channels
+                if module.padding == "same":
+                    continue
+
+                padding = 0 if module.padding == "valid" else module.padding[0]
+                receptive_field = module.dilation[0] * (module.kernel_size[0] - 1) + 1
+                size = (size + 2 * padding - receptive_field) // module.stride[0] + 1
+            elif next(module.children(), None) is None and not isinstance(module, SHAPE_PRESERVING_LAYERS):
+                raise ValueError(f"Cannot compute the output shape of {type(module).__name__} in the backbone.")
+        return channels * size**2
 
     def get_example_input_array(self) -> torch.Tensor:
         return torch.zeros(1, self.size**2 + 1)